@@ -1,6 +1,6 @@
-from functools import cached_property
 from typing import Optional
 
+import numba
 import numpy as np
 import sapien.core as sapien
 import transforms3d
@@ -11,11 +11,41 @@ from sapien_env.sim_env.cube_picking_env import CubePickingEnv
 from sapien_env.rl_env.para import ARM_INIT
 from sapien_env.utils.common_robot_utils import generate_free_robot_hand_info, generate_arm_robot_hand_info, generate_panda_info
 
+_QUAT_IDENT = transforms3d.euler.euler2quat(0, 0, 0)
+_QUAT_Z_HALFPI = transforms3d.euler.euler2quat(0, 0, np.pi / 2)
+_QUAT_Y_HALFPI = transforms3d.euler.euler2quat(0, np.pi / 2, 0)
+
+
+@numba.njit(cache=True)
+def _pack_oracle(out, qpos, cp_p, cp_q, lin_v, ang_v, cube_in_palm):
+    # Layout: qpos, cube pose (7), cube velocities (6), cube in palm (3), theta_cos (1)
+    n = qpos.shape[0]
+    for i in range(n):
+        out[i] = qpos[i]
+    for i in range(3):
+        out[n + i] = cp_p[i]
+        out[n + 7 + i] = lin_v[i]
+        out[n + 10 + i] = ang_v[i]
+        out[n + 13 + i] = cube_in_palm[i]
+    for i in range(4):
+        out[n + 3 + i] = cp_q[i]
+    # z_axis . [0, 0, 1] is the z component of the rotated z-axis, i.e. 1 - 2(x^2 + y^2) for q = (w, x, y, z)
+    qx = cp_q[1]
+    qy = cp_q[2]
+    out[n + 16] = 1.0 - 2.0 * (qx * qx + qy * qy)
+
 
 class CubePickingRLEnv(CubePickingEnv, BaseRLEnv):
-    def __init__(self, use_gui=False, frame_skip=5, randomness_scale=1, robot_name="xarm6", **renderer_kwargs):
+    # Plain attributes shadowing the read-only abstract BaseRLEnv properties;
+    # obs_dim depends on the robot and is assigned in __init__
+    horizon = 10000
+    obs_dim = None
+
+    def __init__(self, use_gui=False, frame_skip=5, randomness_scale=1, robot_name="xarm6", debug=False,
+                 **renderer_kwargs):
         super().__init__(use_gui, frame_skip, randomness_scale, use_ray_tracing=False, **renderer_kwargs)
         self.setup(robot_name)
+        self.debug = debug
 
         # Parse link name
         if self.is_robot_free:
@@ -27,97 +57,133 @@ class CubePickingRLEnv(CubePickingEnv, BaseRLEnv):
         else:
             raise NotImplementedError
         self.palm_link_name = info.palm_name
-        self.palm_link = [link for link in self.robot.get_links() if link.get_name() == self.palm_link_name][0]
-        
+        name_to_link = {link.get_name(): link for link in self.robot.get_links()}
+        self.palm_link = name_to_link[self.palm_link_name]
+
         # Finger tip: thumb, index, middle, ring
         finger_tip_names = ["panda_leftfinger", "panda_rightfinger"]
-        
-        robot_link_names = [link.get_name() for link in self.robot.get_links()]
-        self.finger_tip_links = [self.robot.get_links()[robot_link_names.index(name)] for name in finger_tip_names]
+        self.finger_tip_links = [name_to_link[name] for name in finger_tip_names]
 
         # Object init pose
         self.object_episode_init_pose = sapien.Pose()
 
-    def get_oracle_state(self):
-        # 1. Robot joint positions
-        robot_qpos_vec = self.robot.get_qpos()
+        # Cube pose, palm pose and cube in palm offset of the current step, see update_cached_state
+        self._step_poses = None
 
-        # 2. Cube pose (position + quaternion)
-        cube_pose = self.cube.get_pose()
-        cube_pose_vec = np.concatenate([cube_pose.p, cube_pose.q])
+        # Oracle state scratch buffer: qpos, cube pose (7), cube velocities (6), cube in palm (3), theta_cos (1)
+        self._ndof = self.robot.dof
+        self._oracle_buf = np.empty(self._ndof + 7 + 6 + 3 + 1, dtype=np.float64)
+        # Robot state scratch buffer: qpos, palm position (3), same dtype as SAPIEN's qpos
+        self._robot_state_buf = np.empty(self._ndof + 3, dtype=self.robot.get_qpos().dtype)
+        # Cube in palm scratch owned by the per-step pose cache
+        self._delta3 = np.empty(3, dtype=np.float64)
 
-        # 3. Cube velocities
-        linear_v = self.cube.get_velocity()
-        angular_v = self.cube.get_angular_velocity()
+        # Success thresholds: cube within 5cm of the palm in XY and lifted above the table (z=0.6)
+        self._xy_thresh2 = 0.05 ** 2
+        self._z_thresh = 0.65
 
-        # 4. Distance between cube and robot palm
-        palm_pose = self.palm_link.get_pose()
-        cube_in_palm = cube_pose.p - palm_pose.p
-
-        # 5. Cube uprightness (alignment of z-axis)
-        z_axis = cube_pose.to_transformation_matrix()[:3, 2]
-        theta_cos = np.dot(z_axis, np.array([0, 0, 1]))
-
-        # Combine into oracle state vector
-        return np.concatenate([
-            robot_qpos_vec,
-            cube_pose_vec,
-            linear_v,
-            angular_v,
-            cube_in_palm,
-            np.array([theta_cos])
-        ])
-
-    def get_robot_state(self):
-        robot_qpos_vec = self.robot.get_qpos()
-        palm_pose = self.palm_link.get_pose()
-        return np.concatenate([robot_qpos_vec, palm_pose.p])
+        self.obs_dim = (self.robot.dof + 7 + 6 + 3 + 1) if not self.use_visual_obs else len(self.get_robot_state())
 
-    def get_reward(self, action):
-        # Reward is 1.0 if the cube is close to the gripper and lifted above a height threshold
-        cube_pose = self.cube.get_pose()
-        palm_pose = self.palm_link.get_pose()
+        # Reset targets are constant across episodes, build them once and choose the robot reset function
+        if self.is_xarm:
+            self._reset_qpos = np.zeros(self.robot.dof)
+            self._reset_qpos[:self.arm_dof] = self.robot_info.arm_init_qpos
+            self._robot_init_pose = sapien.Pose(ARM_INIT + self.robot_info.root_offset, _QUAT_IDENT)
+            self._reset_robot_fn = self._reset_arm
+        elif self.is_panda:
+            self._reset_qpos = np.array(self.robot_info.arm_init_qpos, dtype=np.float64)
+            self._robot_init_pose = sapien.Pose(np.array([0.0, -0.5, 0.0]), _QUAT_Z_HALFPI)
+            self._reset_robot_fn = self._reset_arm
+        else:
+            self._robot_init_pose = sapien.Pose(np.array([-0.4, 0, 0.2]), _QUAT_Y_HALFPI)
+            self._reset_robot_fn = self._reset_free
 
-        # Distance threshold in XY plane
-        xy_dist = np.linalg.norm(cube_pose.p[:2] - palm_pose.p[:2])
-        xy_thresh = 0.05
+        # Fixed pose at center of table, slightly above surface
+        cube_center_pos = np.array([0.0, 0.0, 0.3])  # Z = table height (0.6) + half cube height (0.025)
+        self._cube_fixed_pose = sapien.Pose(cube_center_pos, _QUAT_IDENT)
 
-        # Height threshold for lifting
-        z_thresh = 0.65  # Table is at z=0.6, cube lifted if > 0.65
+    def update_cached_state(self):
+        # Query the cube and palm poses once for the observation and the reward of this step.
+        # get_reward is the last consumer in BaseRLEnv.step and clears the cache, as does reset(),
+        # so getters called outside a step query SAPIEN directly
+        cube_pose = self.cube.get_pose()
+        palm_pose = self.palm_link.get_pose()
+        self._step_poses = (cube_pose, palm_pose, np.subtract(cube_pose.p, palm_pose.p, out=self._delta3))
 
-        reward = (xy_dist < xy_thresh) and (cube_pose.p[2] > z_thresh)
+    def get_oracle_state(self, cube_pose=None, palm_pose=None):
+        if cube_pose is None and palm_pose is None and self._step_poses is not None:
+            cube_pose, palm_pose, cube_in_palm = self._step_poses
+        else:
+            if cube_pose is None:
+                cube_pose = self.cube.get_pose()
+            if palm_pose is None:
+                palm_pose = self.palm_link.get_pose()
+            # Write straight into the cube in palm slice of the oracle buffer
+            n = self._ndof
+            cube_in_palm = np.subtract(cube_pose.p, palm_pose.p, out=self._oracle_buf[n + 13:n + 16])
+
+        # Robot qpos, cube pose, cube velocities, cube in palm and cube uprightness
+        _pack_oracle(self._oracle_buf, self.robot.get_qpos(), cube_pose.p, cube_pose.q,
+                     self.cube.get_velocity(), self.cube.get_angular_velocity(), cube_in_palm)
+
+        # Observations are kept by the caller across steps, so hand out a copy of the scratch buffer
+        return self._oracle_buf.copy()
+
+    def get_robot_state(self, palm_pose=None):
+        if palm_pose is None:
+            palm_pose = self._step_poses[1] if self._step_poses is not None else self.palm_link.get_pose()
+        b = self._robot_state_buf
+        b[:-3] = self.robot.get_qpos()
+        b[-3:] = palm_pose.p
+        return b.copy()
+
+    def get_reward(self, action, cube_pose=None, palm_pose=None):
+        # Reward is 1.0 if the cube is close to the gripper and lifted above a height threshold
+        if cube_pose is None and palm_pose is None and self._step_poses is not None:
+            cube_pose, palm_pose, cube_in_palm = self._step_poses
+            dx = cube_in_palm[0]
+            dy = cube_in_palm[1]
+        else:
+            if cube_pose is None:
+                cube_pose = self.cube.get_pose()
+            if palm_pose is None:
+                palm_pose = self.palm_link.get_pose()
+            dx = cube_pose.p[0] - palm_pose.p[0]
+            dy = cube_pose.p[1] - palm_pose.p[1]
+        self._step_poses = None
+
+        # Squared distance in XY plane, compared against the squared threshold
+        xy_d2 = dx * dx + dy * dy
+
+        reward = (xy_d2 < self._xy_thresh2) and (cube_pose.p[2] > self._z_thresh)
         return float(reward)
 
-    def reset(self, *, seed: Optional[int] = None, return_info: bool = False, options: Optional[dict] = None):
-        # Set robot initial joint config and pose
-        if self.is_xarm:
-            qpos = np.zeros(self.robot.dof)
-            arm_qpos = self.robot_info.arm_init_qpos
-            qpos[:self.arm_dof] = arm_qpos
-            self.robot.set_qpos(qpos)
-            self.robot.set_drive_target(qpos)
-            init_pos = ARM_INIT + self.robot_info.root_offset
-            init_pose = sapien.Pose(init_pos, transforms3d.euler.euler2quat(0, 0, 0))
+    def _reset_arm(self):
+        self.robot.set_qpos(self._reset_qpos)
+        self.robot.set_drive_target(self._reset_qpos)
+        self.robot.set_pose(self._robot_init_pose)
+        return self._robot_init_pose
 
-        elif self.is_panda:
-            qpos = self.robot_info.arm_init_qpos.copy()
-            self.robot.set_qpos(qpos)
-            self.robot.set_drive_target(qpos)
-            init_pos = np.array([0.0, -0.5, 0.0])
-            init_ori = transforms3d.euler.euler2quat(0, 0, np.pi / 2)
-            init_pose = sapien.Pose(init_pos, init_ori)
+    def _reset_free(self):
+        self.robot.set_pose(self._robot_init_pose)
+        return self._robot_init_pose
 
-        else:
-            init_pose = sapien.Pose(np.array([-0.4, 0, 0.2]), transforms3d.euler.euler2quat(0, np.pi / 2, 0))
+    def reset(self, *, seed: Optional[int] = None, return_info: bool = False, options: Optional[dict] = None):
+        self._step_poses = None
 
-        self.robot.set_pose(init_pose)
-        print("📍 [Debug] Set robot init pose to:", init_pose.p)
+        # Set robot initial joint config and pose
+        init_pose = self._reset_robot_fn()
+        if self.debug:
+            print("📍 [Debug] Set robot init pose to:", init_pose.p)
         self.reset_env()
         self.reset_internal()
 
         # Stabilize simulation before placing objects
-        for _ in range(100):
-            self.robot.set_qf(self.robot.compute_passive_force(external=False, coriolis_and_centrifugal=False))
+        # Gravity compensation barely changes while settling, so only refresh it every few steps
+        for i in range(100):
+            if i % 10 == 0:
+                qf = self.robot.compute_passive_force(external=False, coriolis_and_centrifugal=False)
+            self.robot.set_qf(qf)
             self.scene.step()
 
         # ✅ Use init_states if provided (from evaluation .hdf5)
@@ -128,11 +194,8 @@ class CubePickingRLEnv(CubePickingEnv, BaseRLEnv):
             # self.object_episode_init_pose = self.generate_random_init_pose(self.randomness_scale)
             # self.cube.set_pose(self.object_episode_init_pose)
             # Fixed pose at center of table, slightly above surface
-            cube_center_pos = np.array([0.0, 0.0, 0.3])  # Z = table height (0.6) + half cube height (0.025)
-            cube_center_quat = transforms3d.euler.euler2quat(0, 0, 0)
-            fixed_pose = sapien.Pose(cube_center_pos, cube_center_quat)
-            self.object_episode_init_pose = fixed_pose
-            self.cube.set_pose(fixed_pose)
+            self.object_episode_init_pose = self._cube_fixed_pose
+            self.cube.set_pose(self._cube_fixed_pose)
 
         return self.get_observation()
 
@@ -187,20 +250,9 @@ class CubePickingRLEnv(CubePickingEnv, BaseRLEnv):
         self.object_episode_init_pose = cube_pose
 
 
-    @cached_property
-    def obs_dim(self):
-        if not self.use_visual_obs:
-            return self.robot.dof + 7 + 6 + 3 + 1
-        else:
-            return len(self.get_robot_state())
-
     def is_done(self):
         return self.current_step >= self.horizon
 
-    @cached_property
-    def horizon(self):
-        return 10000
-
 
 # def main_env():
 #     env = HangMugRLEnv(use_gui=True, robot_name="panda", frame_skip=10, use_visual_obs=False)
@@ -313,12 +365,11 @@ def add_default_scene_light(scene: sapien.Scene, renderer: sapien.VulkanRenderer
     scene.set_ambient_light([0.3, 0.3, 0.3])
 
 def main_env():
-    import imageio
     import os
-    from sapien_env.gui.gui_base import GUIBase, YX_TABLE_TOP_CAMERAS
-    #from sapien_env.utils.render_scene_utils import add_default_scene_light
     import sapien.core as sapien
-    import cv2  # For resizing
+
+    # Set RECORD_VIDEO=1 to render the table top cameras and write a video
+    RECORD = os.environ.get("RECORD_VIDEO", "0") == "1"
 
     # Setup environment
     env = CubePickingRLEnv(
@@ -331,45 +382,55 @@ def main_env():
     env.seed(42)
     env.reset()
 
-    # Set up camera system (headless rendering)
-    add_default_scene_light(env.scene, env.renderer)
-    gui = GUIBase(env.scene, env.renderer, headless=True)
+    if RECORD:
+        import imageio
+        import cv2  # For resizing
+        from sapien_env.gui.gui_base import GUIBase, YX_TABLE_TOP_CAMERAS
+        #from sapien_env.utils.render_scene_utils import add_default_scene_light
 
-    # Add cameras defined in YX_TABLE_TOP_CAMERAS
-    for name, params in YX_TABLE_TOP_CAMERAS.items():
-        if 'rotation' in params:
-            gui.create_camera_from_pos_rot(position=params['position'], rotation=params['rotation'], name=name)
-        else:
-            gui.create_camera(position=params['position'], look_at_dir=params['look_at_dir'], right_dir=params['right_dir'], name=name)
+        # Set up camera system (headless rendering)
+        add_default_scene_light(env.scene, env.renderer)
+        gui = GUIBase(env.scene, env.renderer, headless=True)
 
-    # Prepare to write video
-    save_dir = "./video_output"
-    os.makedirs(save_dir, exist_ok=True)
-    video_path = os.path.join(save_dir, "cube_picking_env.mp4")
+        # Add cameras defined in YX_TABLE_TOP_CAMERAS
+        for name, params in YX_TABLE_TOP_CAMERAS.items():
+            if 'rotation' in params:
+                gui.create_camera_from_pos_rot(position=params['position'], rotation=params['rotation'], name=name)
+            else:
+                gui.create_camera(position=params['position'], look_at_dir=params['look_at_dir'], right_dir=params['right_dir'], name=name)
 
-    writer = imageio.get_writer(video_path, fps=20)
+        # 2x3 panel of 320x240 tiles, each camera view is resized straight into its tile
+        panel = np.empty((480, 960, 3), dtype=np.uint8)
+        tiles = [panel[r * 240:(r + 1) * 240, c * 320:(c + 1) * 320] for r in range(2) for c in range(3)]
+        if len(gui.cams) != len(tiles):
+            raise ValueError(f"Video panel expects {len(tiles)} cameras, but {len(gui.cams)} were created.")
+
+        # Prepare to write video
+        save_dir = "./video_output"
+        os.makedirs(save_dir, exist_ok=True)
+        video_path = os.path.join(save_dir, "cube_picking_env.mp4")
+
+        writer = imageio.get_writer(video_path, fps=20)
 
     for i in range(200):
         action = np.zeros(env.arm_dof + 1)
         action[2] = 0.01  
         obs, reward, done, _ = env.step(action)
 
-        rgbs = gui.render()
-
-        resized_rgbs = [cv2.resize(rgb, (320, 240)) for rgb in rgbs]
-
-        row1 = np.concatenate(resized_rgbs[:3], axis=1)
-        row2 = np.concatenate(resized_rgbs[3:], axis=1)
-        panel = np.concatenate([row1, row2], axis=0)
+        if RECORD:
+            rgbs = gui.render()
 
-        writer.append_data(panel)
+            for tile, rgb in zip(tiles, rgbs):
+                cv2.resize(rgb, (320, 240), dst=tile)
 
-        # for rgb in rgbs:
-        #     writer.append_data(rgb)
+            writer.append_data(panel)
 
-    writer.close()
-    print(f"Saved video to {video_path}")
+            # for rgb in rgbs:
+            #     writer.append_data(rgb)
 
+    if RECORD:
+        writer.close()
+        print(f"Saved video to {video_path}")
 
 if __name__ == '__main__':
     main_env()